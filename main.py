@@ -1,58 +1,373 @@
 # -*- coding: utf-8 -*-
 import requests
-import json
-from bs4 import BeautifulSoup
+import orjson
+import re
+from bs4 import BeautifulSoup, SoupStrainer
+import soupsieve
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
+import threading
 import os
-import yfinance as yf
 from datetime import datetime
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 
 # --- Notion API 설정 ---
 NOTION_API_KEY = os.environ.get('NOTION_API_KEY')
 DATABASE_ID = os.environ.get('DATABASE_ID')
 # --------------------
 
+MAX_WORKERS = 10 # 종목 동시 처리 스레드 수
+YAHOO_BATCH_SIZE = 20 # 야후 시세 요청 1회당 최대 종목 수
+YAHOO_CACHE_TTL = 300 # 야후 시세 재사용 시간 (초)
+NOTION_MAX_WORKERS = 3 # 노션 PATCH 동시 전송 수
+NOTION_RATE_LIMIT = 3 # 노션 API 허용량 (평균 초당 3회)
+NAVER_RATE_LIMIT = 5 # 네이버 증권 초당 요청 수
+UNCHANGED_EPSILON = 0.005 # 이 차이 미만이면 가격/환율이 같은 것으로 간주
+NOTION_PAGE_SIZE = 100 # 노션 DB 쿼리 1회당 최대 결과 수
+FX_CACHE_PATH = ".fx_cache.json" # 환율 캐시 파일
+FX_CACHE_TTL = 3600 # 환율 캐시 유효 시간 (초)
+_EMPTY = {} # 누락된 키용 기본값 (읽기 전용으로만 사용)
+
 NOTION_API_URL = "https://api.notion.com/v1"
+NAVER_ITEM_URL = "https://finance.naver.com/item/main.naver"
+YAHOO_CHART_URL = "https://query1.finance.yahoo.com/v8/finance/chart"
+YAHOO_SPARK_URL = "https://query1.finance.yahoo.com/v8/finance/spark"
 headers = {
     "Authorization": f"Bearer {NOTION_API_KEY}",
     "Content-Type": "application/json",
     "Notion-Version": "2022-06-28",
 }
 
+def _make_session(default_headers: dict) -> requests.Session:
+    """호스트별 커넥션을 재사용하는 세션 생성 (keep-alive + 재시도)"""
+    s = requests.Session()
+    s.headers.update(default_headers)
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32,
+                          max_retries=Retry(total=3, backoff_factor=0.5))
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+# 노션 / 네이버 / 야후 요청은 각각 하나의 세션으로 TLS 연결을 재사용
+session = _make_session(headers)
+naver_session = _make_session({'User-Agent': 'Mozilla/5.0'})
+# 야후는 기본 requests User-Agent를 차단하므로 브라우저 UA 사용
+yahoo_session = _make_session({'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+                                             '(KHTML, like Gecko) Chrome/124.0 Safari/537.36'})
+
+class RateLimiter:
+    """스레드 안전 토큰 버킷 (초당 rate회, 비어 있을 때만 대기하고 최대 rate회까지는 연속 허용)"""
+
+    def __init__(self, rate: float, per: float = 1.0):
+        self.capacity = rate
+        self.fill_rate = rate / per
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.fill_rate
+            time.sleep(wait)
+
+# 야후 시세 메모리 캐시: 심볼 -> (가격, 조회 시각). 노션 쿼리 묶음 간 같은 종목 재요청 방지
+_yahoo_quotes = {}
+
+# 호스트별 요청 속도 제한 (여러 스레드가 공유)
+notion_limiter = RateLimiter(NOTION_RATE_LIMIT)
+naver_limiter = RateLimiter(NAVER_RATE_LIMIT)
+_notion_slots = threading.Semaphore(NOTION_MAX_WORKERS)
+
+def _load_cached_rate(path: str = FX_CACHE_PATH, ttl: int = FX_CACHE_TTL):
+    """디스크에 저장된 환율이 유효 시간(ttl초) 이내면 반환, 없거나 만료되면 None"""
+    try:
+        with open(path, "rb") as f:
+            cached = orjson.loads(f.read())
+        if time.time() - cached["ts"] < ttl:
+            return float(cached["rate"])
+    except Exception:
+        pass
+    return None
+
+def _save_cached_rate(rate: float, path: str = FX_CACHE_PATH):
+    """조회한 환율을 조회 시각과 함께 디스크에 저장"""
+    try:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps({"rate": rate, "ts": time.time()}))
+    except OSError as e:
+        print(f"  [환율 경고] 환율 캐시를 저장하지 못했습니다: {e}")
+
 def get_usd_to_krw_rate() -> float:
-    """실시간 USD/KRW 환율 조회 (실패 시 기본값 1350.0 반환)"""
+    """USD/KRW 환율 조회 (캐시 우선, 실패 시 기본값 1350.0 반환)"""
+    cached = _load_cached_rate()
+    if cached is not None:
+        return cached
     try:
-        data = yf.Ticker("KRW=X")
-        rate = data.history(period="1d")['Close'].iloc[-1]
-        return float(rate)
+        rate = _last_price("KRW=X")
     except Exception as e:
         print(f"  [환율 경고] 환율 정보를 가져오지 못했습니다. 기본값을 사용합니다: {e}")
         return 1350.0
+    _save_cached_rate(rate)
+    return rate
+
+# 네이버 종목 페이지의 현재가 (p.no_today > em > span.blind 구조에 고정, 다르면 파싱 경로로 넘김)
+_PRICE_RE = re.compile(rb'class="no_today">\s*<em[^>]*>\s*<span class="blind">([\d,]+)</span>')
+# 정규식 실패 시 사용하는 파싱 경로: #chart_area 영역만 파싱하고, 선택자는 미리 컴파일
+_CHART_STRAINER = SoupStrainer("div", id="chart_area")
+_PRICE_SELECTOR = soupsieve.compile("#chart_area > div.rate_info > div > p.no_today > em > span.blind")
 
 def get_domestic_price(item_code: str) -> float:
     """네이버 증권 국내 주가 조회"""
-    url = f"https://finance.naver.com/item/main.naver?code={item_code}"
     try:
-        response = requests.get(url, headers={'User-Agent': 'Mozilla/5.0'}, timeout=10)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        price_element = soup.select_one("#chart_area > div.rate_info > div > p.no_today > em > span.blind")
+        naver_limiter.acquire()
+        response = naver_session.get(NAVER_ITEM_URL, params={"code": item_code}, timeout=10)
+        m = _PRICE_RE.search(response.content)
+        if m:
+            return float(m.group(1).replace(b",", b""))
+        # 마크업이 달라 정규식이 실패하면 HTML 파싱으로 재시도
+        soup = BeautifulSoup(response.content, 'lxml', parse_only=_CHART_STRAINER)
+        price_element = _PRICE_SELECTOR.select_one(soup)
         return float(price_element.text.replace(",", "")) if price_element else 0.0
     except Exception:
         return 0.0
 
-def get_overseas_price(ticker: str) -> float:
-    """yfinance 해외 주가 조회"""
+def _last_valid(values) -> float:
+    """시세 배열에서 마지막 유효값 반환 (장중 미체결 구간의 None 제외, 없으면 0.0)"""
+    for v in reversed(values or []):
+        if v is not None:
+            return float(v)
+    return 0.0
+
+def _last_price(symbol: str) -> float:
+    """야후 파이낸스 차트 API로 최근 가격 조회 (실패 시 예외 발생)"""
+    res = yahoo_session.get(f"{YAHOO_CHART_URL}/{symbol}", params={"range": "1d", "interval": "1d"}, timeout=5)
+    res.raise_for_status()
+    d = orjson.loads(res.content)["chart"]["result"][0]
+    # meta의 현재가를 바로 사용하고, 없을 때만 종가 배열에서 마지막 값을 찾음
+    price = d.get("meta", _EMPTY).get("regularMarketPrice") or _last_valid(d["indicators"]["quote"][0]["close"])
+    if price <= 0:
+        raise ValueError(f"{symbol} 가격 정보 없음")
+    return float(price)
+
+def get_overseas_prices(tickers: list) -> dict:
+    """야후 파이낸스 해외 주가 일괄 조회 (최근 조회분은 재사용, 나머지를 YAHOO_BATCH_SIZE개씩 묶어 요청)"""
+    now = time.monotonic()
+    prices = {}
+    for ticker in tickers:
+        cached = _yahoo_quotes.get(ticker)
+        if cached and now - cached[1] < YAHOO_CACHE_TTL:
+            prices[ticker] = cached[0]
+    missing = [ticker for ticker in tickers if ticker not in prices]
+    for i in range(0, len(missing), YAHOO_BATCH_SIZE):
+        chunk = missing[i:i + YAHOO_BATCH_SIZE]
+        try:
+            res = yahoo_session.get(YAHOO_SPARK_URL, timeout=10, params={
+                "symbols": ",".join(chunk), "range": "1d", "interval": "1d"})
+            res.raise_for_status()
+            data = orjson.loads(res.content)
+        except Exception as e:
+            print(f"  [해외 시세 경고] {', '.join(chunk)} 조회 실패: {e}")
+            continue
+        for ticker in chunk:
+            close = _last_valid((data.get(ticker) or _EMPTY).get("close"))
+            if close > 0:
+                prices[ticker] = round(close, 2)
+                _yahoo_quotes[ticker] = (prices[ticker], time.monotonic())
+    return prices
+
+def update_page(page_id: str, update_props: dict) -> tuple:
+    """노션 페이지 속성 업데이트 후 (성공 여부, 실패 메시지) 반환"""
+    with _notion_slots: # 동시 PATCH 수 제한
+        notion_limiter.acquire()
+        try:
+            res = session.patch(f"{NOTION_API_URL}/pages/{page_id}",
+                                data=orjson.dumps({"properties": update_props}), timeout=10)
+        except Exception as e:
+            return False, str(e)
+    return res.status_code == 200, res.text
+
+def _query_database(cursor: str = None) -> dict:
+    """노션 DB 쿼리 한 번 요청 (cursor가 있으면 해당 위치부터)"""
+    body = {"page_size": NOTION_PAGE_SIZE}
+    if cursor:
+        body["start_cursor"] = cursor
+    notion_limiter.acquire()
+    res = session.post(f"{NOTION_API_URL}/databases/{DATABASE_ID}/query", data=orjson.dumps(body), timeout=15)
+    res.raise_for_status()
+    return orjson.loads(res.content)
+
+def iter_pages():
+    """노션 DB의 모든 페이지를 묶음 단위로 반환 (호출 측이 처리하는 동안 다음 묶음을 미리 요청)"""
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        future = prefetcher.submit(_query_database)
+        while True:
+            data = future.result()
+            has_more = data.get("has_more") and data.get("next_cursor")
+            if has_more:
+                future = prefetcher.submit(_query_database, data["next_cursor"])
+            yield data.get("results", [])
+            if not has_more:
+                break
+
+# --- 노션 속성 안전하게 읽기 (Missing Key 방지) ---
+Record = namedtuple("Record", "name code category auto_buy buy_freq last_buy fixed_amount fixed_qty qty "
+                               "prev_price prev_rate")
+
+def _plain_text(items, default: str = "") -> str:
+    return items[0].get("plain_text", default).strip() if items else default
+
+def _select_name(prop: dict) -> str:
+    s = prop.get("select")
+    return s.get("name") if s else ""
+
+def extract(props: dict) -> Record:
+    """노션 페이지 속성을 한 번에 읽어 Record로 반환"""
+    get = props.get
+    last_buy = get("최근 매수일", _EMPTY).get("date")
+    return Record(
+        name=_plain_text(get("종목명", _EMPTY).get("title"), "Unknown"),
+        code=_plain_text(get("종목코드", _EMPTY).get("rich_text")),
+        category=_select_name(get("분류", _EMPTY)), # '국내' 또는 '해외'
+        auto_buy=get("자동 매수", _EMPTY).get("checkbox", False),
+        buy_freq=_select_name(get("매수 주기", _EMPTY)), # '매일', '화요일' 등
+        last_buy=last_buy.get("start") if last_buy else "",
+        fixed_amount=get("정액 매수 금액", _EMPTY).get("number") or 0,
+        fixed_qty=get("자동 매수 수량", _EMPTY).get("number") or 0,
+        qty=get("수량", _EMPTY).get("number") or 0,
+        prev_price=get("현재가", _EMPTY).get("number"), # 비어 있으면 None
+        prev_rate=get("환율", _EMPTY).get("number"),
+    )
+
+def _unchanged(prev, new: float) -> bool:
+    """노션에 저장된 값(prev)과 새 값이 UNCHANGED_EPSILON 이내로 같은지 여부"""
+    return prev is not None and abs(prev - new) < UNCHANGED_EPSILON
+
+# 분류별 1주당 원화 매수 비용 (가격, 환율)
+COST_PER_SHARE = {
+    "국내": lambda price, rate: price,
+    "해외": lambda price, rate: price * rate,
+}
+
+def process_page(page_id: str, r: Record, fetchers: dict, exchange_rate: float,
+                 today_str: str, is_tuesday: bool) -> list:
+    """종목 하나의 가격 조회, 자동 매수 계산, 노션 업데이트 수행 후 출력할 로그 줄 반환"""
+    log = [f"\n- 처리 중: {r.name} ({r.code})"]
+    # 분류별 처리 함수를 먼저 정함 (알 수 없는 분류는 국내로 처리하지 않고 건너뜀)
     try:
-        stock = yf.Ticker(ticker)
-        price_info = stock.history(period="1d")
-        return round(float(price_info['Close'].iloc[-1]), 2) if not price_info.empty else 0.0
-    except Exception:
-        return 0.0
+        fetch_price, cost_of = fetchers[r.category], COST_PER_SHARE[r.category]
+    except KeyError:
+        log.append(f"  [경고] {r.name}의 분류 '{r.category}'를 알 수 없습니다('국내'/'해외'). 업데이트를 건너뜁니다.")
+        return log
+
+    try:
+        # 3. 가격 조회
+        price = fetch_price(r.code)
+        if price <= 0:
+            log.append(f"  [경고] {r.name}의 가격 정보를 가져올 수 없습니다. 업데이트를 건너뜁니다.")
+            return log
+
+        # 기본 업데이트 항목 (현재가, 환율)
+        update_props = {
+            "현재가": {"number": price},
+            "환율": {"number": exchange_rate}
+        }
+
+        # 4. 자동 매수 판별 로직
+        should_buy = False
+        # 조건: 체크박스 ON + 오늘 아직 매수 안 함
+        if r.auto_buy and r.last_buy != today_str:
+            if r.buy_freq == "매일":
+                should_buy = True
+            elif r.buy_freq == "화요일" and is_tuesday:
+                should_buy = True
+
+        # 5. 매수 수량 계산
+        if should_buy:
+            add_qty = 0.0
+            # A. 정액 매수 (금액 / 현재가)
+            if r.fixed_amount > 0:
+                cost_per_share = cost_of(price, exchange_rate)
+                add_qty = r.fixed_amount / cost_per_share
+            # B. 정량 매수 (지정된 수량만큼)
+            elif r.fixed_qty > 0:
+                add_qty = r.fixed_qty
+
+            if add_qty > 0:
+                new_total_qty = round(r.qty + add_qty, 4)
+                update_props["수량"] = {"number": new_total_qty}
+                update_props["최근 매수일"] = {"date": {"start": today_str}}
+                log.append(f"  -> [자동 매수 성공] {add_qty:.4f}주 추가 (합계: {new_total_qty})")
+
+        # 가격/환율이 그대로이고 매수도 없으면 전송 생략 (장 마감 후, 주말 등)
+        if "수량" not in update_props and _unchanged(r.prev_price, price) and _unchanged(r.prev_rate, exchange_rate):
+            log.append("  -> 변경 사항 없음, 업데이트를 건너뜁니다.")
+            return log
+
+        # 6. 노션 전송
+        ok, message = update_page(page_id, update_props)
+        log.append("  -> 정보 업데이트 완료" if ok else f"  -> [업데이트 실패] {message}")
+    except Exception as e:
+        log.append(f"  [오류] {r.name} 처리 중 예외 발생: {e}")
+    return log
+
+def _once_per_code(fetch):
+    """종목코드별로 한 번만 조회하는 함수 반환 (먼저 요청한 스레드가 조회하고, 같은 코드의 나머지는 그 결과를 기다림)"""
+    futures = {}
+    lock = threading.Lock()
+
+    def fetch_once(code: str) -> float:
+        with lock:
+            future = futures.get(code)
+            owner = future is None
+            if owner:
+                future = futures[code] = Future()
+        if owner:
+            try:
+                future.set_result(fetch(code))
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+    return fetch_once
+
+def process_pages(pages: list, exchange_rate: float, today_str: str, is_tuesday: bool):
+    """쿼리 결과 한 묶음을 종목별로 스레드에서 동시에 처리 (노션 전송은 update_page에서 동시 수 제한)"""
+    records = [] # (페이지 ID, Record)
+    for page in pages:
+        try:
+            page_id = page["id"]
+            record = extract(page.get("properties", {}))
+        except Exception as e:
+            print(f"  [오류] 페이지 {page.get('id')} 속성을 읽지 못했습니다: {e}")
+            continue
+        if record.code and record.category:
+            records.append((page_id, record))
+
+    overseas_prices = get_overseas_prices(list(dict.fromkeys(r.code for _, r in records if r.category == "해외")))
+    # 분류별 가격 조회 함수 (국내는 묶음 안 중복 종목을 한 번만, 해외는 위에서 묶어서 조회한 결과 사용)
+    fetchers = {
+        "국내": _once_per_code(get_domestic_price),
+        "해외": lambda code: overseas_prices.get(code, 0.0),
+    }
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        logs = executor.map(lambda pr: process_page(*pr, fetchers, exchange_rate, today_str, is_tuesday), records)
+        for log in logs: # 종목 순서대로 한 번에 출력해 로그가 섞이지 않도록 함
+            print("\n".join(log))
 
 def main():
+    # 실행 시각 기준 값은 한 번만 계산해 모든 종목에서 공유
     now = datetime.now()
     today_str = now.strftime('%Y-%m-%d')
-    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 자동화 프로세스 시작")
+    is_tuesday = now.weekday() == 1 # 1: 화요일
+    print(f"[{now.strftime('%Y-%m-%d %H:%M:%S')}] 자동화 프로세스 시작")
     
     if not NOTION_API_KEY or not DATABASE_ID:
         print("[오류] 환경 변수(Secrets) 설정이 누락되었습니다.")
@@ -62,104 +377,18 @@ def main():
     exchange_rate = get_usd_to_krw_rate()
     print(f"현재 환율: 1 USD = {exchange_rate:,.2f} KRW")
 
-    # 2. 노션 데이터베이스 쿼리
-    query_url = f"{NOTION_API_URL}/databases/{DATABASE_ID}/query"
-    try:
-        response = requests.post(query_url, headers=headers, timeout=15)
-        response.raise_for_status()
-        pages = response.json().get("results", [])
-    except Exception as e:
-        print(f"[API 오류] 노션 데이터베이스를 불러오지 못했습니다: {e}")
-        return
-
-    for page in pages:
+    # 2. 노션 데이터베이스 쿼리 (100건씩, 현재 묶음을 처리하는 동안 다음 묶음을 미리 요청)
+    pages_iter = iter_pages()
+    while True:
+        # 쿼리 실패만 여기서 처리 (종목별 오류는 process_pages 안에서 종목 단위로 처리)
         try:
-            page_id = page["id"]
-            props = page.get("properties", {})
-
-            # --- 데이터 안전하게 읽기 (Missing Key 방지) ---
-            def get_text(prop_name):
-                p = props.get(prop_name, {}).get("rich_text", [])
-                return p[0].get("plain_text", "").strip() if p else ""
-
-            def get_title(prop_name):
-                p = props.get(prop_name, {}).get("title", [])
-                return p[0].get("plain_text", "Unknown").strip() if p else "Unknown"
-
-            def get_select(prop_name):
-                s = props.get(prop_name, {}).get("select")
-                return s.get("name") if s else ""
-
-            name = get_title("종목명")
-            code = get_text("종목코드")
-            category = get_select("분류") # '국내' 또는 '해외'
-            
-            if not code or not category:
-                continue
-
-            print(f"\n- 처리 중: {name} ({code})")
-
-            # 수치 데이터 안전하게 읽기
-            auto_buy_enabled = props.get("자동 매수", {}).get("checkbox", False)
-            buy_freq = get_select("매수 주기") # '매일', '화요일' 등
-            last_buy_date = props.get("최근 매수일", {}).get("date", {}).get("start") if props.get("최근 매수일", {}).get("date") else ""
-            
-            fixed_amount = props.get("정액 매수 금액", {}).get("number", 0) or 0
-            fixed_qty = props.get("자동 매수 수량", {}).get("number", 0) or 0
-            current_qty = props.get("수량", {}).get("number", 0) or 0
-
-            # 3. 가격 조회
-            price = get_domestic_price(code) if category == "국내" else get_overseas_price(code)
-            
-            if price <= 0:
-                print(f"  [경고] {name}의 가격 정보를 가져올 수 없습니다. 업데이트를 건너뜁니다.")
-                continue
-
-            # 기본 업데이트 항목 (현재가, 환율)
-            update_props = {
-                "현재가": {"number": price},
-                "환율": {"number": exchange_rate}
-            }
-
-            # 4. 자동 매수 판별 로직
-            should_buy = False
-            # 조건: 체크박스 ON + 오늘 아직 매수 안 함
-            if auto_buy_enabled and last_buy_date != today_str:
-                if buy_freq == "매일":
-                    should_buy = True
-                elif buy_freq == "화요일" and now.weekday() == 1: # 1: 화요일
-                    should_buy = True
-
-            # 5. 매수 수량 계산
-            if should_buy:
-                add_qty = 0.0
-                # A. 정액 매수 (금액 / 현재가)
-                if fixed_amount > 0:
-                    cost_per_share = price * exchange_rate if category == "해외" else price
-                    add_qty = fixed_amount / cost_per_share
-                # B. 정량 매수 (지정된 수량만큼)
-                elif fixed_qty > 0:
-                    add_qty = fixed_qty
-                
-                if add_qty > 0:
-                    new_total_qty = round(current_qty + add_qty, 4)
-                    update_props["수량"] = {"number": new_total_qty}
-                    update_props["최근 매수일"] = {"date": {"start": today_str}}
-                    print(f"  -> [자동 매수 성공] {add_qty:.4f}주 추가 (합계: {new_total_qty})")
-
-            # 6. 노션 전송
-            update_url = f"{NOTION_API_URL}/pages/{page_id}"
-            res = requests.patch(update_url, headers=headers, data=json.dumps({"properties": update_props}), timeout=10)
-            if res.status_code == 200:
-                print(f"  -> 정보 업데이트 완료")
-            else:
-                print(f"  -> [업데이트 실패] {res.text}")
-
-        except Exception as e:
-            print(f"  [오류] {name} 처리 중 예외 발생: {e}")
-            continue # 다음 종목으로 넘어감
-
-        time.sleep(0.5)
+            pages = next(pages_iter, None)
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
+            print(f"[API 오류] 노션 데이터베이스를 불러오지 못했습니다: {e}")
+            return
+        if pages is None:
+            break
+        process_pages(pages, exchange_rate, today_str, is_tuesday)
 
     print("\n모든 종목의 작업이 완료되었습니다.")
 